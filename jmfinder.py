@@ -10,19 +10,23 @@ Thank you!
 """
 import hashlib
 import json
+import socket
 import struct
 import sys
 from argparse import ArgumentParser, Namespace
-from collections import Counter
-from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from enum import Enum
-from itertools import chain
+from http.client import HTTPConnection
+from itertools import islice
 from logging import Logger, getLogger, Formatter, StreamHandler
 from math import ceil
+from operator import itemgetter
+from os import makedirs, cpu_count
+from os.path import join, expanduser, dirname
+from queue import Queue, Empty, Full
 from time import monotonic
-from typing import Tuple, Dict, Any, List, Generator, Optional
-from urllib.error import URLError, HTTPError
-from urllib.request import urlopen, Request
+from typing import Tuple, Dict, Any, List, Generator, Optional, Union, Iterable, TextIO
 
 log: Optional[Logger] = None
 
@@ -38,6 +42,27 @@ log: Optional[Logger] = None
 MIN_PARTICIPANTS = 3
 MIN_CJ_AMOUNT = 75000
 
+# Maximum number of blocks requested concurrently to the REST server.
+# Each in-flight request takes a slot in Bitcoin Core's HTTP work queue,
+# see -rpcworkqueue.
+MAX_PREFETCH = 16
+
+# Block hashes are cached across runs in CACHE_DIR, one file per chain.
+# Chains are told apart by the hash of block 1, all signets share the same genesis block.
+# Only blocks with at least FINALITY_DEPTH confirmations are cached.
+CACHE_DIR = join(expanduser('~'), '.cache', 'jmfinder')
+FINALITY_DEPTH = 100
+
+# Precompiled little-endian integer formats
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+_U64 = struct.Struct('<Q')
+
+# Anything struct.unpack_from accepts
+Buffer = Union[bytes, memoryview]
+
+_sha256 = hashlib.sha256
+
 
 def is_jm(n_in: int, n_out: int, values: List[int]) -> Tuple[int, int]:
     """
@@ -52,7 +77,15 @@ def is_jm(n_in: int, n_out: int, values: List[int]) -> Tuple[int, int]:
         return 0, 0
     if n_in < assumed_cj_outs:
         return 0, 0
-    most_common_value, equal_outs = Counter(values).most_common(1)[0]
+    counts: Dict[int, int] = {}
+    for value in values:
+        counts[value] = counts.get(value, 0) + 1
+    # Every distinct value but one takes at least one output,
+    # too many of them and no value can be repeated enough
+    if len(counts) > n_out - assumed_cj_outs + 1:
+        return 0, 0
+    # Same as Counter.most_common(1), ties go to the value seen first
+    most_common_value, equal_outs = max(counts.items(), key=itemgetter(1))
     if most_common_value < MIN_CJ_AMOUNT:
         return 0, 0
     if equal_outs != assumed_cj_outs:
@@ -125,6 +158,12 @@ def get_args() -> Namespace:
         help='Use N processes, default to the number of processors on the machine. Pass 0 to prevent multiprocessing',
         metavar='N',
     )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        dest='no_cache',
+        help='Do not read nor write the block hash cache, in ~/.cache/jmfinder',
+    )
     parser.add_argument(
         '-v',
         '--verbose',
@@ -167,6 +206,7 @@ class RestApi(Enum):
     # instead of the complete transaction details
     BLOCK_NO_DETAILS = '/block/notxdetails'
     # Given a count and a block hash, return amount of block headers in upward direction
+    # The block itself is included
     HEADERS = '/headers'
     # Given a height, return hash of block at height provided
     BLOCKHASH = '/blockhashbyheight'
@@ -187,7 +227,10 @@ class RestApi(Enum):
         """
         Return complete URI for RestApi.
         """
-        return f"{self.value}{''.join(f'/{arg}' for arg in args)}{req_type.value}"
+        uri = self.value
+        for arg in args:
+            uri += f'/{arg}'
+        return uri + req_type.value
 
 
 class Btc:
@@ -195,33 +238,143 @@ class Btc:
     Client object to interact with REST interface.
     """
 
-    __slots__ = ('url',)
+    __slots__ = ('url', 'host', 'port', '_connections', '_hash_cache', '_hash_cache_path', '_finalized_height')
 
     HEADERS = {'User-Agent': 'jmfinder'}
     TIMEOUT = 3
+    # Max number of idle keep-alive connections kept for reuse
+    POOL_SIZE = MAX_PREFETCH
+    # Max number of headers returned by a single Headers call
+    MAX_HEADERS = 2000
+    # Prebuilt paths for the methods called for every block
+    BLOCK_BIN_PATH = f'/rest{RestApi.BLOCK.value}/{{}}{ReqType.BIN.value}'
+    BLOCKHASH_BIN_PATH = f'/rest{RestApi.BLOCKHASH.value}/{{}}{ReqType.BIN.value}'
 
     def __init__(self, host: str, port: int):
         self.url = f'http://{host}:{port}'
+        self.host = host
+        self.port = port
+        # Thread safe, connections are shared by the fetching threads
+        self._connections: 'Queue[HTTPConnection]' = Queue(self.POOL_SIZE)
+        # Block hashes by height, see load_hash_cache()
+        self._hash_cache: Dict[int, str] = {}
+        self._hash_cache_path: Optional[str] = None
+        self._finalized_height = -1
+
+    def load_hash_cache(self, path: str, start_block: int, end_block: int, finalized_height: int) -> None:
+        """
+        Load block hashes cached by previous runs from `path`, and append new ones there from now on.
+        Only blocks up to `finalized_height` are cached, deep enough to not be expected to be reorged,
+        so the cache never needs to be invalidated.
+        Only the cached hashes in the scanned range are kept in memory.
+        """
+        self._finalized_height = finalized_height
+        last_block = min(end_block, finalized_height)
+        try:
+            with open(path, 'r', encoding='UTF-8') as f:
+                for line in f:
+                    height, _, blockhash = line.strip().partition(',')
+                    if len(blockhash) == 64 and start_block <= int(height) <= last_block:
+                        self._hash_cache[int(height)] = blockhash
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as exc:
+            log.warning(f'Ignoring block hash cache {path}: {exc}')
+            return
+        self._hash_cache_path = path
+        log.debug(f'Loaded {len(self._hash_cache)} cached block hashes from {path}')
+
+    def _cache_hashes(self, hashes: Dict[int, str]) -> None:
+        """
+        Add finalized block hashes to the cache and write them to the cache file.
+        """
+        new = {height: blockhash for height, blockhash in hashes.items()
+               if height <= self._finalized_height and height not in self._hash_cache}
+        if not new:
+            return
+        self._hash_cache.update(new)
+        if self._hash_cache_path is None:
+            return
+        try:
+            makedirs(dirname(self._hash_cache_path), exist_ok=True)
+            with open(self._hash_cache_path, 'a', encoding='UTF-8') as f:
+                f.writelines(f'{height},{blockhash}\n' for height, blockhash in new.items())
+        except OSError as exc:
+            log.warning(f'Unable to write block hash cache {self._hash_cache_path}: {exc}')
+            self._hash_cache_path = None
+
+    def _new_connection(self) -> HTTPConnection:
+        return HTTPConnection(self.host, self.port, timeout=self.TIMEOUT)
+
+    def _get_connection(self) -> HTTPConnection:
+        try:
+            return self._connections.get_nowait()
+        except Empty:
+            return self._new_connection()
+
+    def _close_connections(self) -> None:
+        """
+        Close and drop all the idle connections in the pool.
+        """
+        while True:
+            try:
+                self._connections.get_nowait().close()
+            except Empty:
+                return
+
+    def _put_connection(self, conn: HTTPConnection) -> None:
+        try:
+            self._connections.put_nowait(conn)
+        except Full:
+            conn.close()
 
     def get_response(self, method: RestApi, *args, req_type: ReqType = ReqType.JSON) -> bytes:
         """
-        Send HTTP request to the server.
+        Send HTTP request for given RestApi method to the server.
+        """
+        return self._request(f'/rest{method.to_uri(req_type, *args)}')
+
+    def _request(self, path: str) -> bytes:
+        """
+        Send HTTP request to the server, reusing a keep-alive connection if there's one available.
         If the call succeeds, return raw response in bytes.
         Else log error and terminate the script, the "rationale" for this is below.
         """
-        url = f'{self.url}/rest{method.to_uri(req_type, *args)}'
-        request = Request(url, headers=self.HEADERS)
-        try:
-            with urlopen(request, timeout=self.TIMEOUT) as response:
-                return response.read()
-        except HTTPError as exc:
-            log.error(f'Bad status code: {exc.code} {exc.reason}')
-        except URLError as exc:
-            log.error(f'Unable to connect to {url}: {exc.reason}')
-        except TimeoutError:
-            log.error('Request timed out')
-        except Exception as exc:
-            log.error(str(exc))
+        url = f'{self.url}{path}'
+        conn = self._get_connection()
+        for retry in (False, True):
+            reused = conn.sock is not None
+            try:
+                conn.request('GET', path, headers=self.HEADERS)
+                response = conn.getresponse()
+                body = response.read()
+            except (ConnectionResetError, BrokenPipeError) as exc:
+                conn.close()
+                if reused and not retry:
+                    # The server closes idle keep-alive connections (see -rpcservertimeout),
+                    # the other pooled ones are likely closed too, drop them and retry once
+                    # with a new connection
+                    log.debug(f'Connection reset, retrying {url}: {exc}')
+                    self._close_connections()
+                    conn = self._new_connection()
+                    continue
+                log.error(f'Unable to connect to {url}: {exc}')
+            except socket.timeout:
+                conn.close()
+                log.error('Request timed out')
+            except OSError as exc:
+                conn.close()
+                log.error(f'Unable to connect to {url}: {exc}')
+            except Exception as exc:
+                conn.close()
+                log.error(str(exc))
+            else:
+                if response.status == 200:
+                    self._put_connection(conn)
+                    return body
+                conn.close()
+                log.error(f'Bad status code: {response.status} {response.reason}')
+            break
         log.error(f'Request for {url} failed')
         # Failed to perform HTTP request.
         # Since this is a standalone script, we are okay stopping the program here.
@@ -241,13 +394,62 @@ class Btc:
         """
         return self.get_json(RestApi.BLOCK_NO_DETAILS if no_details else RestApi.BLOCK, blockhash)
 
+    def get_block_bin(self, blockhash: str) -> bytes:
+        """
+        Wrapper around Block method, return the block in binary format
+        """
+        return self._request(self.BLOCK_BIN_PATH.format(blockhash))
+
+    def get_blockhash_bin(self, height: int) -> bytes:
+        """
+        Wrapper around Blockhash method, return the 32 raw bytes of the hash (internal byte order)
+        """
+        return self._request(self.BLOCKHASH_BIN_PATH.format(height))
+
     def get_blockhash(self, height: int) -> str:
         """
-        Wrapper around Blockhash method
+        Wrapper around Blockhash method, return the hash as hex the way the REST interface expects it.
+        Binary format, no need to go through JSON for a single value.
         """
-        blockhash: str = (self.get_json(RestApi.BLOCKHASH, height))['blockhash']
+        blockhash = self._hash_cache.get(height)
+        if blockhash is None:
+            blockhash = format_hash(self.get_blockhash_bin(height))
+            self._cache_hashes({height: blockhash})
         return blockhash
 
+    def get_blockhashes(self, start_block: int, end_block: int) -> Generator[str, Any, None]:
+        """
+        Yield the hash of each block from start_block to end_block.
+        Instead of a Blockhash call per height, hashes are computed from
+        the block headers, fetched MAX_HEADERS at a time.
+        Cached hashes are used as long as there's one for each height.
+        """
+        height = start_block
+        while height <= end_block and height in self._hash_cache:
+            yield self._hash_cache[height]
+            height += 1
+        if height > end_block:
+            return
+        blockhash = self.get_blockhash(height)
+        remaining = end_block - height + 1
+        # Each chunk after the first starts from the last header already yielded
+        skip = 0
+        while remaining > 0:
+            count = min(self.MAX_HEADERS, remaining + skip)
+            headers = self.get_response(RestApi.HEADERS, count, blockhash, req_type=ReqType.BIN)
+            if len(headers) != count * 80:
+                log.error(f'Expected {count} headers starting from block {blockhash}, got {len(headers) // 80}')
+                sys.exit(ExitStatus.FAILURE.value)
+            hashes = {}
+            for offset in range(skip * 80, len(headers), 80):
+                blockhash = format_hash(double_sha256(headers[offset:offset + 80]))
+                hashes[height] = blockhash
+                height += 1
+            self._cache_hashes(hashes)
+            yield from hashes.values()
+            remaining -= count - skip
+            skip = 1
+
     def get_info(self) -> Dict[str, Any]:
         """
         Wrapper around Chaininfo method
@@ -255,52 +457,160 @@ class Btc:
         return self.get_json(RestApi.CHAININFO)
 
 
-def double_sha256(data: bytes) -> bytes:
-    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+def double_sha256(data: Buffer) -> bytes:
+    """
+    hashlib is backed by OpenSSL, which uses the CPU SHA extensions (SHA-NI, ARMv8 SHA2) when available.
+    """
+    return _sha256(_sha256(data).digest()).digest()
 
 
 def format_hash(hash_: bytes) -> str:
     return hash_[::-1].hex()
 
 
-def decode_uint32(data: bytes) -> int:
-    if len(data) != 4:
-        raise ValueError
-    return struct.unpack("<I", data)[0]
+def decode_uint32(data: Buffer, offset: int = 0) -> int:
+    return _U32.unpack_from(data, offset)[0]
 
 
-def decode_uint64(data: bytes) -> int:
-    if len(data) != 8:
-        raise ValueError
-    return struct.unpack("<Q", data)[0]
+def decode_uint64(data: Buffer, offset: int = 0) -> int:
+    return _U64.unpack_from(data, offset)[0]
 
 
-def decode_varint(data: bytes) -> Tuple[int, int]:
-    size = int(data[0])
-    if size > 255:
-        raise ValueError
+def decode_varint(data: Buffer, offset: int = 0) -> Tuple[int, int]:
+    """
+    Return a tuple with the decoded value and the offset right after the varint.
+    """
+    size = data[offset]
     if size < 253:
-        return size, 1
+        return size, offset + 1
     if size == 253:
-        format_ = '<H'
-    elif size == 254:
-        format_ = '<I'
-    elif size == 255:
-        format_ = '<Q'
-    else:
-        # Should never be reached
-        raise ValueError(f"Unknown format for size : {size}")
-    size = struct.calcsize(format_)
-    return struct.unpack(format_, data[1:size + 1])[0], size + 1
+        return _U16.unpack_from(data, offset + 1)[0], offset + 3
+    if size == 254:
+        return _U32.unpack_from(data, offset + 1)[0], offset + 5
+    return _U64.unpack_from(data, offset + 1)[0], offset + 9
+
+
+def fetch_block(blockhash: str, height: int, btc: Btc) -> Tuple[bytes, int]:
+    """
+    Return a tuple with the block in binary format and its height.
+    """
+    return btc.get_block_bin(blockhash), height
 
 
 def get_blocks(start_block: int, end_block: int, btc: Btc) -> Generator[Tuple[bytes, int], Any, None]:
     """
     Yield a tuple with each block in binary format and its height.
+    Blocks are fetched by a pool of MAX_PREFETCH threads. Up to as many more blocks are queued
+    behind the requests in flight, so that a thread never waits for the next block to be submitted.
     """
-    for height in range(start_block, end_block + 1):
-        blockhash = btc.get_blockhash(height)
-        yield btc.get_response(RestApi.BLOCK, blockhash, req_type=ReqType.BIN), height
+    blocks = zip(btc.get_blockhashes(start_block, end_block), range(start_block, end_block + 1))
+    with ThreadPoolExecutor(MAX_PREFETCH) as executor:
+        pending = deque(executor.submit(fetch_block, blockhash, height, btc)
+                        for blockhash, height in islice(blocks, 2 * MAX_PREFETCH))
+        try:
+            while pending:
+                block_data = pending.popleft().result()
+                # Keep the window full while the caller is busy with this block
+                for blockhash, height in islice(blocks, 1):
+                    pending.append(executor.submit(fetch_block, blockhash, height, btc))
+                yield block_data
+        finally:
+            # If we are stopping early (failed request, interrupted or closed by the caller),
+            # cancel the queued blocks not requested yet so that shutting down the pool
+            # only waits for the requests already in flight
+            for future in pending:
+                future.cancel()
+
+
+def skip_inputs(buf: Buffer, offset: int, n_in: int) -> int:
+    """
+    Return the offset right after the `n_in` inputs starting at `offset`.
+    Nothing is needed from the inputs, so they are only skipped.
+    """
+    varint = decode_varint
+    for _ in range(n_in):
+        # Skip previous outpoint (36 bytes)
+        offset += 36
+        script_length = buf[offset]
+        if script_length < 253:
+            # Single byte varint, then script and sequence (4 bytes)
+            offset += script_length + 5
+        else:
+            script_length, offset = varint(buf, offset)
+            offset += script_length + 4
+    return offset
+
+
+def parse_tx(buf: Buffer, offset: int) -> Tuple[int, int, int, List[int], bool, int, int, int]:
+    """
+    Parse the transaction starting at `offset` in `buf`, in a single forward pass.
+    Return a tuple with tx size, number of inputs, number of outputs, output values,
+    whether it's segwit, absolute offset where the witnesses start (or the locktime if not segwit),
+    version and locktime.
+    Raise IndexError or struct.error if the transaction is malformed or incomplete.
+
+    This is the hot loop of the script: single byte varints (i.e., almost all script
+    and witness lengths) are decoded inline and globals are bound to locals.
+    """
+    varint = decode_varint
+    # The transaction's version number
+    version = decode_uint32(buf, offset)
+
+    is_segwit = False
+
+    tx_offset = offset + 4
+
+    # Adds basic support for segwit transactions
+    #   - https://bitcoincore.org/en/segwit_wallet_dev/
+    #   - https://en.bitcoin.it/wiki/Protocol_documentation#BlockTransactions
+    if buf[tx_offset] == 0 and buf[tx_offset + 1] == 1:
+        is_segwit = True
+        tx_offset += 2
+
+    n_in, tx_offset = varint(buf, tx_offset)
+
+    # Parse inputs
+
+    tx_offset = skip_inputs(buf, tx_offset, n_in)
+
+    n_out, tx_offset = varint(buf, tx_offset)
+
+    # Parse outputs
+
+    values: List[int] = []
+    # Bound to locals, this loop runs for every output in the block
+    unpack_value = _U64.unpack_from
+    append_value = values.append
+    for _ in range(n_out):
+        # The value of the output expressed in sats
+        append_value(unpack_value(buf, tx_offset)[0])
+        tx_offset += 8
+        script_length = buf[tx_offset]
+        if script_length < 253:
+            tx_offset += 1
+        else:
+            script_length, tx_offset = varint(buf, tx_offset)
+        tx_offset += script_length
+
+    offset_before_tx_witnesses = tx_offset
+
+    # Parse witnesses
+
+    if is_segwit:
+        for _ in range(n_in):
+            tx_witnesses_n, tx_offset = varint(buf, tx_offset)
+            for _ in range(tx_witnesses_n):
+                component_length = buf[tx_offset]
+                if component_length < 253:
+                    tx_offset += 1
+                else:
+                    component_length, tx_offset = varint(buf, tx_offset)
+                tx_offset += component_length
+
+    # The transaction's locktime as int
+    locktime = decode_uint32(buf, tx_offset)
+    tx_size = tx_offset + 4 - offset
+    return tx_size, n_in, n_out, values, is_segwit, offset_before_tx_witnesses, version, locktime
 
 
 def parse_block(block_data: Tuple[bytes, int]) -> List[str]:
@@ -312,130 +622,69 @@ def parse_block(block_data: Tuple[bytes, int]) -> List[str]:
     processed_txs = 0
     block, height = block_data
 
-    # Skip the header
-    txs_data = block[80:]
+    # Memoryview slices do not copy the underlying data
+    txs_data = memoryview(block)
 
-    # The number of transactions contained in this block
-    n_txs, block_offset = decode_varint(txs_data)
+    # The number of transactions contained in this block, right after the 80 bytes header
+    n_txs, block_offset = decode_varint(txs_data, 80)
 
     # Loop through the block's transactions
     for i in range(n_txs):
-        tx_size = 0
-        # Try from 1024 (1KiB) -> 1073741824 (1GiB) slice widths
-        for j in range(0, 20):
-            try:
-                # Parse tx
-
-                offset_e = block_offset + (1024 * 2 ** j)
-                tx = txs_data[block_offset:offset_e]
-                # The transaction's version number
-                version = decode_uint32(tx[:4])
-                # The transaction's locktime as int
-                locktime = decode_uint32(tx[-4:])
-
-                is_segwit = False
-
-                tx_offset = 4
-
-                # Adds basic support for segwit transactions
-                #   - https://bitcoincore.org/en/segwit_wallet_dev/
-                #   - https://en.bitcoin.it/wiki/Protocol_documentation#BlockTransactions
-                if tx[tx_offset:tx_offset + 2] == b'\x00\x01':
-                    is_segwit = True
-                    tx_offset += 2
-
-                n_in, varint_size = decode_varint(tx[tx_offset:])
-                tx_offset += varint_size
-
-                # Parse inputs
-
-                for _ in range(n_in):
-                    tx_input = tx[tx_offset:]
-                    script_length, varint_length = decode_varint(tx_input[36:])
-                    script_start = 36 + varint_length
-                    in_size = script_start + script_length + 4
-                    tx_offset += in_size
-
-                n_out, varint_size = decode_varint(tx[tx_offset:])
-                tx_offset += varint_size
-
-                # Parse outputs
-
-                values = []
-                for _ in range(n_out):
-                    tx_output = tx[tx_offset:]
-                    _value_hex = tx_output[:8]
-                    # The value of the output expressed in sats
-                    values.append(decode_uint64(_value_hex))
-                    script_length, varint_size = decode_varint(tx_output[8:])
-                    script_start = 8 + varint_size
-                    out_size = script_start + script_length
-                    tx_offset += out_size
-
-                # Parse witnesses
-
-                if is_segwit:
-                    offset_before_tx_witnesses = tx_offset
-                    for _ in range(n_in):
-                        tx_witnesses_n, varint_size = decode_varint(tx[tx_offset:])
-                        tx_offset += varint_size
-                        for _ in range(tx_witnesses_n):
-                            component_length, varint_size = decode_varint(tx[tx_offset:])
-                            tx_offset += varint_size
-                            tx_offset += component_length
-
-                tx_size = tx_offset + 4
-                tx = tx[:tx_size]
-                if tx_size != len(tx):
-                    raise ValueError("Incomplete transaction")
-
-                # Segwit transactions have two transaction ids/hashes, txid and wtxid
-                # txid is a hash of all of the legacy transaction fields only
-                if is_segwit:
-                    txid_data = tx[:4] + tx[6:offset_before_tx_witnesses] + tx[-4:]
-                else:
-                    txid_data = tx
-                txid = format_hash(double_sha256(txid_data))
-
-                # The transaction size in virtual bytes.
-                if not is_segwit:
-                    vsize = tx_size
-                else:
-                    # The witness is the last element in a transaction before the
-                    # 4 byte locktime and self._offset_before_tx_witnesses is the
-                    # position where the witness starts
-                    witness_size = tx_size - offset_before_tx_witnesses - 4
-
-                    # Size of the transaction without the segwit marker (2 bytes) and
-                    # the witness
-                    stripped_size = tx_size - (2 + witness_size)
-                    weight = stripped_size * 3 + tx_size
-
-                    # Vsize is weight / 4 rounded up
-                    vsize = ceil(weight / 4)
-
-                # Check for JoinMarket pattern
-                most_common_value, equal_outs = is_jm(n_in, n_out, values)
-                if most_common_value > 0:
-                    results.append(f'{txid},{height},{i}')
-                    log.info(f'\n\nFound possible JoinMarket CoinJoin at height {height}\n'
-                             f'TXID: {txid}\n'
-                             f'Inputs: {n_in}\n'
-                             f'Outputs: {n_out}\n'
-                             f'Equal value outputs: {equal_outs}\n'
-                             f'Equal output amount: {most_common_value}\n'
-                             f'Vsize: {vsize}\n'
-                             f'Version: {version}\n'
-                             f'Locktime: {locktime}\n')
-                processed_txs += 1
-                break
-
-            except Exception as exc:
-                # raise exc
-                continue
-
+        try:
+            tx_size, n_in, n_out, values, is_segwit, offset_before_tx_witnesses, version, locktime = parse_tx(
+                txs_data, block_offset)
+        except (IndexError, struct.error) as exc:
+            log.error(f'Unable to parse transaction {i} in block at height {height}: {exc!r}')
+            break
+        processed_txs += 1
+        tx_start = block_offset
         # Skipping to the next transaction
-        block_offset += tx_size
+        block_offset = tx_end = tx_start + tx_size
+
+        # Check for JoinMarket pattern
+        most_common_value, equal_outs = is_jm(n_in, n_out, values)
+        if not most_common_value:
+            continue
+
+        # Only candidates need the txid, hashing every transaction is by far the most expensive step
+
+        # Segwit transactions have two transaction ids/hashes, txid and wtxid
+        # txid is a hash of all of the legacy transaction fields only
+        if is_segwit:
+            txid_data = b''.join((txs_data[tx_start:tx_start + 4],
+                                  txs_data[tx_start + 6:offset_before_tx_witnesses],
+                                  txs_data[tx_end - 4:tx_end]))
+        else:
+            txid_data = txs_data[tx_start:tx_end]
+        txid = format_hash(double_sha256(txid_data))
+
+        # The transaction size in virtual bytes.
+        if not is_segwit:
+            vsize = tx_size
+        else:
+            # The witness is the last element in a transaction before the
+            # 4 byte locktime and offset_before_tx_witnesses is the
+            # position where the witness starts
+            witness_size = tx_end - offset_before_tx_witnesses - 4
+
+            # Size of the transaction without the segwit marker (2 bytes) and
+            # the witness
+            stripped_size = tx_size - (2 + witness_size)
+            weight = stripped_size * 3 + tx_size
+
+            # Vsize is weight / 4 rounded up
+            vsize = ceil(weight / 4)
+
+        results.append(f'{txid},{height},{i}')
+        log.info(f'\n\nFound possible JoinMarket CoinJoin at height {height}\n'
+                 f'TXID: {txid}\n'
+                 f'Inputs: {n_in}\n'
+                 f'Outputs: {n_out}\n'
+                 f'Equal value outputs: {equal_outs}\n'
+                 f'Equal output amount: {most_common_value}\n'
+                 f'Vsize: {vsize}\n'
+                 f'Version: {version}\n'
+                 f'Locktime: {locktime}\n')
 
     # Make sure we have parsed all the transactions in the block
     if processed_txs != n_txs:
@@ -445,6 +694,60 @@ def parse_block(block_data: Tuple[bytes, int]) -> List[str]:
     return results
 
 
+def parse_blocks(blocks: Iterable[Tuple[bytes, int]],
+                 executor: ProcessPoolExecutor,
+                 window: int) -> Generator[List[str], Any, None]:
+    """
+    Yield parse_block results for each block, in the same order, parsing them in a pool of processes.
+    Unlike executor.map, which submits everything upfront, at most `window` blocks are waiting
+    to be parsed, so blocks are fetched only as fast as they are parsed and don't pile up in memory.
+    """
+    pending: 'deque[Future[List[str]]]' = deque()
+    try:
+        for block_data in blocks:
+            pending.append(executor.submit(parse_block, block_data))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def write_candidates(f: TextIO, blocks_results: Iterable[List[str]]) -> None:
+    """
+    Append the identifiers found in each block to the candidates file as soon as they are available,
+    so that an interrupted scan doesn't lose them.
+    """
+    for results in blocks_results:
+        if results:
+            f.writelines(f'{result}\n' for result in results)
+            f.flush()
+
+
+def sort_candidates(path: str) -> None:
+    """
+    Remove duplicates from the candidates file and sort them by block height and index.
+    """
+    seen = set()
+    candidates: List[Tuple[int, int, str]] = []
+    with open(path, 'r+', encoding='UTF-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line in seen:
+                continue
+            seen.add(line)
+            # TXID,height,index, sort keys are parsed once per line
+            _, height, index = line.split(',', 2)
+            candidates.append((int(height), int(index), line))
+        candidates.sort()
+        # Clear the old content
+        f.seek(0)
+        f.truncate()
+        f.writelines(f'{line}\n' for _, _, line in candidates)
+
+
 def main() -> None:
     args = get_args()
     global log
@@ -462,26 +765,35 @@ def main() -> None:
             log.error(f"Can't scan past pruned height. Given start height ({start_block}) is lower than "
                       f"lowest-height complete block stored ({info['pruneheight']}).")
             sys.exit(ExitStatus.ARGERROR.value)
+    # Regtest chains are throwaway, the same height means different blocks across runs.
+    # Nothing to gain from the cache if no block in the range is finalized
+    finalized_height = info['blocks'] - FINALITY_DEPTH
+    if not args.no_cache and info['chain'] != 'regtest' and start_block <= finalized_height:
+        chain_id = format_hash(btc.get_blockhash_bin(1))
+        btc.load_hash_cache(join(CACHE_DIR, f"{info['chain']}-{chain_id}.txt"),
+                            start_block, end_block, finalized_height)
     log.info(f'Scanning from block {start_block} to block {end_block}')
     start_time = monotonic()
-    if args.jobs == 0:
-        # Synchronous, do not use ProcessPoolExecutor
-        results = list(chain.from_iterable(map(parse_block, get_blocks(start_block, end_block, btc))))
-    else:
-        # Asynchronous using a pool of args.jobs processes
-        # If args.jobs is None, uses all available processors
-        with ProcessPoolExecutor(args.jobs) as executor:
-            results = list(chain.from_iterable(executor.map(parse_block, get_blocks(start_block, end_block, btc))))
-    log.info(f'Scan completed in {monotonic() - start_time:.2f}s')
     with open(args.candidate_file_name, 'a+', encoding='UTF-8') as f:
-        # Go to the beginning of the file
-        f.seek(0)
-        lines = (line.strip() for line in chain(f.readlines(), results))
-        # Remove duplicates and sort by block height
-        result = sorted(set(lines), key=lambda x: x.split(',')[1])
-        # Clear the old content
-        f.truncate(0)
-        f.writelines('\n'.join(result))
+        # Files written by older versions don't end with a newline
+        if f.tell() > 0:
+            f.seek(f.tell() - 1)
+            if f.read(1) != '\n':
+                f.write('\n')
+        blocks = get_blocks(start_block, end_block, btc)
+        if args.jobs == 0:
+            # Synchronous, do not use ProcessPoolExecutor
+            write_candidates(f, map(parse_block, blocks))
+        else:
+            # Asynchronous using a pool of args.jobs processes
+            # If args.jobs is None, uses all available processors
+            with ProcessPoolExecutor(args.jobs) as executor:
+                # Enough queued blocks to keep every process busy,
+                # the default pool size is capped at 61 processes on Windows
+                jobs = args.jobs if args.jobs is not None else min(cpu_count() or 1, 61)
+                write_candidates(f, parse_blocks(blocks, executor, jobs * 2))
+    log.info(f'Scan completed in {monotonic() - start_time:.2f}s')
+    sort_candidates(args.candidate_file_name)
 
 
 if __name__ == "__main__":
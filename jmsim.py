@@ -10,12 +10,14 @@ To get that:
 from concurrent.futures import ProcessPoolExecutor
 import sys
 from argparse import ArgumentParser, Namespace, ArgumentTypeError
+from bisect import bisect
 from decimal import Decimal
 from enum import Enum
+from itertools import accumulate
 from json import loads
 from logging import Logger, getLogger, StreamHandler, Formatter
 from os.path import isfile
-from random import random, choices, randrange
+from random import random, randrange
 from statistics import stdev, mean
 from time import monotonic
 from typing import List, Dict, Any, Tuple, Optional
@@ -177,38 +179,67 @@ def filter_ob_by_fees(offers: List[Dict[str, Any]], max_abs: int, max_rel: float
 
 
 def simulate_order_choose(weights: List[float],
-                          nicks: List[str],
+                          cum_weights: List[float],
+                          bonded: int,
                           maker_count: int,
-                          bondless: float) -> List[str]:
+                          bondless: float) -> List[int]:
     """
-    Return list with the nicks of the selected offers.
+    Return list with the indexes of the selected offers.
+    `cum_weights` are the cumulative `weights`, as computed by itertools.accumulate,
+    and `bonded` is the number of offers with a positive weight.
+    `weights` is modified while choosing and restored before returning,
+    so that the cost of a call depends on `maker_count` and not on the number of offers.
     The order choosing algos are intended to be exactly the same as the JoinMarket ones.
     """
-    chosen_nicks = []
-    # Makes copies to keep the original intact
-    sim_weights = weights[:]
-    sim_nicks = nicks[:]
+    chosen_offers = []
+    # Chosen offers are masked by zeroing their weight instead of being popped from a copy,
+    # zero weight offers are never picked by the weighted choice
+    masked_weights = []
+    chosen = set()
+    n_offers = len(weights)
+    # Valid until an offer with positive weight is chosen, then rebuilt on the next weighted choice
+    sim_cum_weights: Optional[List[float]] = cum_weights
     for _ in range(maker_count):
-        if random() >= bondless and sum(sim_weights) > 0:
+        # bonded > 0 is the same as sum(weights) > 0, kept up to date in O(1)
+        if random() >= bondless and bonded:
             # Use fidelity_bond_weighted_order_choose
-            nick_index = choices(range(len(sim_nicks)), sim_weights, k=1)[0]
+            # Same as random.choices, but the cumulative weights are reused across calls
+            if sim_cum_weights is None:
+                sim_cum_weights = list(accumulate(weights))
+            nick_index = bisect(sim_cum_weights, random() * sim_cum_weights[-1], 0, n_offers - 1)
         else:
             # Use random_under_max_order_choose
-            nick_index = randrange(len(sim_nicks))
-        chosen_nicks.append(sim_nicks[nick_index])
-        sim_weights.pop(nick_index)
-        sim_nicks.pop(nick_index)
+            # Uniform among the offers left, retry if already chosen
+            nick_index = randrange(n_offers)
+            while nick_index in chosen:
+                nick_index = randrange(n_offers)
+        chosen_offers.append(nick_index)
+        chosen.add(nick_index)
+        weight = weights[nick_index]
+        if weight > 0:
+            bonded -= 1
+            sim_cum_weights = None
+        masked_weights.append(weight)
+        weights[nick_index] = 0
 
-    return chosen_nicks
+    for nick_index, weight in zip(chosen_offers, masked_weights):
+        weights[nick_index] = weight
+    return chosen_offers
 
 
-def trial(args: Tuple) -> Dict[str, int]:
-    trial_res = {nick: 0 for nick in args[0]}
-    for _ in range(args[1]):
-        chosen_nicks = simulate_order_choose(
-            args[2], args[0], args[3], args[4])
-        for nick in chosen_nicks:
-            trial_res[nick] += 1
+def trial(args: Tuple) -> List[int]:
+    """
+    Return how many times each offer has been picked in `sample_size` simulations, by offer index.
+    """
+    sample_size, weights, maker_count, bondless = args
+    trial_res = [0] * len(weights)
+    # Copy once per trial, simulate_order_choose masks offers in place
+    sim_weights = weights[:]
+    cum_weights = list(accumulate(weights))
+    bonded = len(weights) - weights.count(0)
+    for _ in range(sample_size):
+        for nick_index in simulate_order_choose(sim_weights, cum_weights, bonded, maker_count, bondless):
+            trial_res[nick_index] += 1
     return trial_res
 
 
@@ -220,7 +251,8 @@ def simulate(weights: List[float], nicks: List[str], trials: int, sample_size: i
     Each result represents times_picked / sample_size.
     """
 
-    args = ((nicks, sample_size, weights, maker_count, bondless) for _ in range(trials))
+    # Trials only deal with offer indexes, nicks are mapped back at the end
+    args = ((sample_size, weights, maker_count, bondless) for _ in range(trials))
     if jobs == 0:
         # Synchronous, do not use ProcessPoolExecutor
         trials_res = list(map(trial, args))
@@ -229,7 +261,7 @@ def simulate(weights: List[float], nicks: List[str], trials: int, sample_size: i
         # If args.jobs is None, uses all available processors
         with ProcessPoolExecutor(jobs) as executor:
             trials_res = list(executor.map(trial, args))
-    res = {nick: [trial_[nick] / sample_size for trial_ in trials_res] for nick in nicks}
+    res = {nick: [trial_[i] / sample_size for trial_ in trials_res] for i, nick in enumerate(nicks)}
     return res
 
 